@@ -20,8 +20,20 @@
 from subprocess import Popen, PIPE, DEVNULL
 from mpd import MPDClient
 from mpd.base import CommandError, ConnectionError
-from sys import argv, stdout, stderr
+from sys import argv, stdout, stderr, executable
 from getopt import gnu_getopt, GetoptError
+from threading import Thread, Event
+from random import randrange
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from os import environ, makedirs, replace
+from os.path import expanduser, join, dirname, abspath
+from time import time, sleep
+from resource import getrusage, RUSAGE_SELF
+from hashlib import sha1
+import gzip
+import json
 import re
 
 def usage():
@@ -41,6 +53,10 @@ usage: mpdmenu [options] [dmenu_cmd]
 
         -t TIMEOUT, --timeout
             Timeout of connection. Must be a number (defaults to 60)
+
+        --autofill
+            Run auto-fill daemon with settings saved by 'auto-fill' action
+            instead of menu. Stopped by 'auto-fill' action or signal
 ''', file=stderr)
 
 dmenu_cmd = 'dmenu'
@@ -51,6 +67,53 @@ def esc_pressed(r):
 def none_selected(r):
     return type(r) is list and len(r) == 0
 
+# Song stickers cached per uri: { name: { file: value } }
+# Filled in bulk by one 'sticker find' per name instead of 'sticker get' per track
+sticker_names = ['rating', 'playcount']
+stickers = {}
+# Set by thread idling on 'sticker' subsystem over separate connection;
+# the cache is refilled on next stickers_refresh
+stickers_stale = Event()
+sticker_watcher = None
+
+def sticker_watch(client):
+    global sticker_watcher
+    def watch():
+        try:
+            while True:
+                client.idle('sticker')
+                stickers_stale.set()
+        except (ConnectionError, OSError):
+            stickers_stale.set()
+    sticker_watcher = Thread(target=watch, daemon=True)
+    sticker_watcher.start()
+
+# Called by menus that show or query stickers only: others don't pay for fetch
+def stickers_refresh(client):
+    watched = sticker_watcher is not None and sticker_watcher.is_alive()
+    if stickers and watched and not stickers_stale.is_set():
+        return
+    # Cleared before fetch: change made during it triggers another one
+    stickers_stale.clear()
+    stickers.clear()
+    for name in sticker_names:
+        values = {}
+        try:
+            songs = client.sticker_find('song', '', name)
+        except CommandError: # sticker database is disabled
+            songs = []
+        for song in songs:
+            # Only one sticker per song: it's filtered by name
+            values[song['file']] = song['sticker'].split('=', 1)[1]
+        stickers[name] = values
+
+def sticker_value(track, name):
+    value = stickers.get(name, {}).get(track['file'])
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
 def sformat_track(index, track):
     a = ['{} '.format(index)]
     if 'artist' in track:
@@ -59,6 +122,9 @@ def sformat_track(index, track):
         a.append(track['title'])
     else:
         a.append(track['file'])
+    rating = sticker_value(track, 'rating')
+    if rating > 0:
+        a.append('  {}'.format('\u2605' * min(rating, 5)))
     return ''.join(a)
 
 def dmenu(input, prompt='', custominput=False):
@@ -139,7 +205,8 @@ def dmenu_select_tracks(tracks, prompt='""', usepos=False, ranges=True):
         else:
             track_at_pos = dict((i, tracks[i]) for i in range(0, len(t)))
         for a,b in ranges:
-            selected_tracks.extend([track_at_pos[i] for i in range(a,b+1)])
+            # Tracks may be filtered out (see sticker_query)
+            selected_tracks.extend([track_at_pos[i] for i in range(a,b+1) if i in track_at_pos])
     else:
         selected_tracks=[]
         if usepos:
@@ -148,7 +215,37 @@ def dmenu_select_tracks(tracks, prompt='""', usepos=False, ranges=True):
             selected_tracks = [tracks[i] for i in indices]
     return selected_tracks
 
+sticker_cmp = {
+    '>=' : lambda a, b: a >= b,
+    '<=' : lambda a, b: a <= b,
+    '>'  : lambda a, b: a > b,
+    '<'  : lambda a, b: a < b,
+    '='  : lambda a, b: a == b,
+}
+sticker_queries = ['rating >= 4', 'rating >= 3', 'sort rating', 'sort playcount']
+
+"""Filter and sort tracks by cached stickers (see stickers_refresh)
+
+Each selected (or typed) line is either '<sticker> <op> <number>'
+or 'sort <sticker>' (descending). Filters are combined with 'and'.
 
+:return: filtered tracks or None if escape is pressed
+"""
+def sticker_query(tracks, prompt='Stickers'):
+    r = dmenu(sticker_queries, prompt=prompt, custominput=True)
+    if esc_pressed(r):
+        return None
+    for line in r:
+        m = re.match(r'\s*sort\s+(\w+)\s*$', line)
+        if m:
+            name = m.group(1)
+            tracks = sorted(tracks, key=lambda t: sticker_value(t, name), reverse=True)
+            continue
+        m = re.match(r'\s*(\w+)\s*(>=|<=|>|<|=)\s*(\d+)\s*$', line)
+        if m:
+            name, op, value = m.group(1), sticker_cmp[m.group(2)], int(m.group(3))
+            tracks = [t for t in tracks if op(sticker_value(t, name), value)]
+    return tracks
 
 def mpd_resume(client, command):
     client.play()
@@ -273,6 +370,33 @@ def execute_query(client, query, function, args=None):
             results += result
     return results;
 
+"""Match track against query immediate representation locally (see execute_query)
+
+'find' compares tags exactly, 'search' as case-insensitive substrings.
+Values of one type are alternatives, types are combined with 'and'.
+"""
+def match_query(track, query, command):
+    for qtype, value in zip(query[0::2], query[1::2]):
+        values = value if type(value) is list else [value]
+        if qtype == 'any':
+            tags = list(track.values())
+        else:
+            tags = track.get(qtype, [])
+        if type(tags) is not list:
+            tags = [tags]
+        # Multi-valued tags are lists: flatten
+        flat = []
+        for tag in tags:
+            flat += tag if type(tag) is list else [tag]
+        tags = flat
+        if command == 'find':
+            found = any(v in tags for v in values)
+        else:
+            found = any(v.lower() in t.lower() for v in values for t in tags)
+        if not found:
+            return False
+    return True
+
 def prompt_save_playlist(client):
     cur_len = int(client.status()['playlistlength'])
     if cur_len > 0:
@@ -299,12 +423,27 @@ def save_playlist(client, prompt='Playlist name', tracks=None):
 
         break
 
-def load_tracks(client, tracks, append=False):
+# Index of current playlist: { file: [pos1, pos2, ...] }, positions ascending
+def queue_index(client):
+    index = {}
+    for track in client.playlistinfo():
+        index.setdefault(track['file'], []).append(int(track['pos']))
+    return index
+
+# If unique, tracks already in current playlist (or repeated in tracks) are skipped
+def load_tracks(client, tracks, append=False, unique=False):
     playlist = client.playlist()
     if not append:
         prompt_save_playlist(client)
         client.clear()
+        playlist = []
+    # Entries of playlist are 'file: <uri>'
+    queued = set(p.split(': ', 1)[-1] for p in playlist) if unique else set()
     for track in tracks:
+        if track['file'] in queued:
+            continue
+        if unique:
+            queued.add(track['file'])
         client.add(track['file'])
 
 LOOP_END = 0
@@ -322,6 +461,7 @@ def search_list(client, query, command):
         s = execute_query(client, query, client.find)
     else:
         s = execute_query(client, query, client.search)
+    stickers_refresh(client)
     tracks = [sformat_track(i, s[i]) for i in range(0,len(s))]
     dmenu(tracks, prompt='Selected')
     return LOOP_CONT
@@ -331,17 +471,34 @@ def search_select(client, query, command):
         s = execute_query(client, query, client.find)
     else:
         s = execute_query(client, query, client.search)
+    return select_load_tracks(client, s)
+
+def search_stickers(client, query, command):
+    if command == 'find':
+        s = execute_query(client, query, client.find)
+    else:
+        s = execute_query(client, query, client.search)
+    # Refreshed once: before filter, not again by select_load_tracks
+    stickers_refresh(client)
+    s = sticker_query(s)
+    if s == None:
+        return LOOP_CONT
+    return select_load_tracks(client, s, refresh=False)
+
+def select_load_tracks(client, s, refresh=True):
+    if refresh:
+        stickers_refresh(client)
     tracks = dmenu_select_tracks(s, 'Select:')
     if esc_pressed(tracks):
         return LOOP_CONT
-    r = dmenu(['play', 'add'], prompt='Action')
+    r = dmenu(['play', 'add', 'add unique'], prompt='Action')
     if esc_pressed(r) or none_selected(r):
         return LOOP_CONT
     action = r[0]
     if action == 'play':
         prompt_save_playlist(client)
         client.clear()
-    load_tracks(client, tracks, append=True)
+    load_tracks(client, tracks, append=True, unique=(action == 'add unique'))
     mpd_resume(client, 'resume')
     return LOOP_END
 
@@ -358,6 +515,7 @@ search_actions = {
     'add'            : search_add,
     'list'           : search_list,
     'select'         : search_select,
+    'stickers'       : search_stickers,
     'play'           : search_play
 }
 
@@ -384,6 +542,7 @@ def mpd_play(client, command):
     if current:
         playlist.remove(current)
         playlist.insert(0, current)
+    stickers_refresh(client)
     tracks = dmenu_select_tracks(playlist, prompt='Play', usepos=True)
     if tracks == None:
         return
@@ -424,12 +583,21 @@ def mpd_playlist_move_tracks(client, playlist, tracks, before=True, playlist_nam
         to += 1
 
 current_playlist_actions = ['play', 'delete', 'crop', 'move before', 'move after']
+# Covers both 'current playlist' and 'rated playlist': the latter is filtered
+# and sorted by stickers first
 def mpd_current_playlist(client, command):
     current = client.currentsong()
     playlist = client.playlistinfo()
     if current in playlist:
         playlist.remove(current)
         playlist.insert(0, current)
+    stickers_refresh(client)
+    # Moves and crop work on whole queue, not just filtered tracks
+    queue = playlist
+    if command == 'rated playlist':
+        playlist = sticker_query(playlist)
+        if playlist == None:
+            return
     tracks = dmenu_select_tracks(playlist, prompt='Playlist', usepos=True)
 
     if tracks == None:
@@ -453,20 +621,21 @@ def mpd_current_playlist(client, command):
             adj += 1
     elif action == 'crop':
         adj = 0
-        for track in playlist:
+        for track in sorted(queue, key=lambda t: int(t['pos'])):
             if track not in tracks:
                 client.delete(int(track['pos'])-adj)
                 adj += 1
     elif action in ['move before', 'move after']:
         before = (action == 'move before')
-        mpd_playlist_move_tracks(client, playlist, tracks, before=before)
+        mpd_playlist_move_tracks(client, queue, tracks, before=before)
     return
 
-playlist_list_actions = ['add', 'play', 'delete', 'crop']
+playlist_list_actions = ['add', 'add unique', 'play', 'delete', 'crop']
 def mpd_playlists_list(client, playlists):
     tracks = []
     for playlist in playlists:
         tracks += client.listplaylistinfo(playlist)
+    stickers_refresh(client)
     while True:
         r = dmenu_select_tracks(tracks, 'Select Tracks:')
         if esc_pressed(r):
@@ -483,6 +652,9 @@ def mpd_playlists_list(client, playlists):
             for track in selected:
                 client.add(track['file'])
             return LOOP_END
+        elif action == 'add unique':
+            load_tracks(client, selected, append=True, unique=True)
+            return LOOP_END
         elif action == 'play':
             load_tracks(client, tracks)
             mpd_resume(client, 'resume')
@@ -513,7 +685,7 @@ def mpd_playlists_rename(client, playlists):
                 continue
             break
 
-playlist_actions = ['add', 'play', 'remove', 'list', 'rename']
+playlist_actions = ['add', 'add unique', 'play', 'play unique', 'remove', 'list', 'rename']
 def mpd_playlists(client, command):
     playlists = client.listplaylists()
     playlists_list = [p['playlist'] for p in playlists]
@@ -541,6 +713,14 @@ def mpd_playlists(client, command):
             for playlist in playlists:
                 client.load(playlist)
             mpd_resume(client, 'resume')
+        elif action in ['add unique', 'play unique']:
+            tracks = []
+            for playlist in playlists:
+                tracks += client.listplaylistinfo(playlist)
+            append = (action == 'add unique')
+            load_tracks(client, tracks, append=append, unique=True)
+            if not append:
+                mpd_resume(client, 'resume')
         elif action == 'remove':
             for playlist in playlists:
                 client.rm(playlist)
@@ -552,6 +732,361 @@ def mpd_playlists(client, command):
             rc = mpd_playlists_rename(client, playlists)
         break
 
+# Merge sorted positions into [start, end) ranges
+def coalesce_ranges(positions):
+    ranges = []
+    for pos in positions:
+        if ranges and ranges[-1][1] == pos:
+            ranges[-1][1] = pos + 1
+        else:
+            ranges.append([pos, pos + 1])
+    return ranges
+
+# Keeps first (or currently playing) occurrence of every file
+def mpd_dedupe(client, command):
+    current = client.currentsong()
+    current_pos = int(current['pos']) if current else None
+    duplicates = []
+    for file, positions in queue_index(client).items():
+        keep = current_pos if current_pos in positions else positions[0]
+        duplicates += [pos for pos in positions if pos != keep]
+    # Delete from the end so that positions of remaining ranges are intact
+    for a, b in reversed(coalesce_ranges(sorted(duplicates))):
+        client.delete((a, b))
+
+# Local snapshot of library: { top-level directory: subtree } (see library_build)
+library = {}
+# (address, port, timeout) of main connection: used to open more of them
+connect_args = ('localhost', 6600, 60)
+library_workers = 4
+
+def cache_path(name):
+    cache = environ.get('XDG_CACHE_HOME', expanduser('~/.cache'))
+    return join(cache, 'mpdmenu', name)
+
+def library_path():
+    address, port, timeout = connect_args
+    return cache_path('library-{}-{}.json.gz'.format(address, port).replace('/', '_'))
+
+"""Append track to columns of subtree
+
+Columns are dictionary encoded: { tag: (values, lookup, index) }, where
+index holds position of row's value in values or -1 if row has no such tag.
+"""
+def columns_append(columns, rows, track):
+    for key, value in track.items():
+        if key not in columns:
+            columns[key] = ([], {}, [])
+        values, lookup, index = columns[key]
+        # Multi-valued tags are lists
+        h = tuple(value) if type(value) is list else value
+        i = lookup.get(h)
+        if i is None:
+            i = lookup[h] = len(values)
+            values.append(value)
+        index.extend([-1] * (rows - len(index)))
+        index.append(i)
+
+def columns_pack(columns, rows):
+    packed = {}
+    for key, (values, lookup, index) in columns.items():
+        index.extend([-1] * (rows - len(index)))
+        if len(values) == rows:
+            # Unique in every row (e.g. file): values are the column itself
+            packed[key] = {'values': values}
+        else:
+            packed[key] = {'values': values, 'index': index}
+    return packed
+
+# Yields rows one by one: whole subtree is never unpacked at once
+def columns_unpack(packed, rows):
+    columns = [(key, column['values'], column.get('index'))
+            for key, column in packed.items()]
+    for row in range(rows):
+        track = {}
+        for key, values, index in columns:
+            i = row if index is None else index[row]
+            if i >= 0:
+                track[key] = values[i]
+        yield track
+
+def subtree_pack(tracks, fingerprint=None):
+    columns = {}
+    rows = 0
+    for track in tracks:
+        if 'file' not in track:
+            continue
+        columns_append(columns, rows, track)
+        rows += 1
+    return {'fingerprint': fingerprint, 'rows': rows,
+            'columns': columns_pack(columns, rows)}
+
+# last-modified of directory itself changes only with its direct entries.
+# Hash of listall uris (much smaller than listallinfo) catches added, removed,
+# renamed and moved songs, newest song last-modified (file mtime) retagged ones.
+# None if server has no filter expressions (MPD < 0.21): always fetched
+def subtree_fingerprint(client, directory):
+    base = '(base "{}")'.format(re.sub(r'(["\\])', r'\\\1', directory['directory']))
+    try:
+        newest = client.find(base, 'sort', '-Last-Modified', 'window', (0, 1))
+    except CommandError:
+        return None
+    uris = sha1()
+    client.iterate = True
+    try:
+        for entry in client.listall(directory['directory']):
+            for key, value in entry.items():
+                uris.update('{}: {}\n'.format(key, value).encode('utf-8'))
+    finally:
+        client.iterate = False
+    return [directory.get('last-modified'), uris.hexdigest(),
+            newest[0].get('last-modified') if newest else None]
+
+def subtree_fetch(pool, directory, old):
+    client = pool.get()
+    try:
+        fingerprint = subtree_fingerprint(client, directory)
+        if old and fingerprint != None and old['fingerprint'] == fingerprint:
+            return old, False
+        # Response is parsed as it is read, not accumulated
+        client.iterate = True
+        try:
+            return subtree_pack(client.listallinfo(directory['directory']),
+                    fingerprint), True
+        finally:
+            client.iterate = False
+    finally:
+        pool.put(client)
+
+"""Build snapshot of library, split by top-level directory
+
+Subtrees are fetched in parallel over library_workers connections and
+only if changed since previous snapshot (see subtree_fingerprint).
+Snapshot is stored as columns (see columns_append) in library_path().
+
+:return: snapshot and stats: (snapshot, tracks, fetched, seconds, peak RSS in KiB)
+"""
+def library_build(client):
+    start = time()
+    path = library_path()
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = {}
+
+    top = client.lsinfo()
+    directories = [d for d in top if 'directory' in d]
+    # Files in root come with lsinfo itself
+    snapshot = {'': subtree_pack(top)}
+    fetched = snapshot['']['rows']
+    pool = Queue()
+    for i in range(min(library_workers, len(directories))):
+        pool.put(mpd_connect(*connect_args))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, pool.qsize())) as executor:
+            jobs = [(d['directory'], executor.submit(subtree_fetch, pool, d,
+                    old.get(d['directory']))) for d in directories]
+            for name, job in jobs:
+                subtree, changed = job.result()
+                snapshot[name] = subtree
+                if changed:
+                    fetched += subtree['rows']
+    finally:
+        while not pool.empty():
+            pool.get().disconnect()
+
+    makedirs(dirname(path), exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    replace(path + '.tmp', path)
+
+    rows = sum(subtree['rows'] for subtree in snapshot.values())
+    return snapshot, rows, fetched, time() - start, getrusage(RUSAGE_SELF).ru_maxrss
+
+# Tracks of snapshot, unpacked one by one
+def library_tracks(snapshot):
+    for subtree in snapshot.values():
+        yield from columns_unpack(subtree['columns'], subtree['rows'])
+
+def library_load(client, reload=False):
+    global library
+    if reload or not library:
+        library = library_build(client)[0]
+    return library
+
+def mpd_library(client, command):
+    global library
+    library, rows, fetched, seconds, rss = library_build(client)
+    dmenu([
+        '{} tracks, {} fetched'.format(rows, fetched),
+        '{:.1f} s, {:.0f} tracks/s'.format(seconds, fetched / max(seconds, 1e-3)),
+        'peak RSS {:.1f} MiB'.format(rss / 1024),
+    ], prompt='Library snapshot')
+
+autofill_units = {
+    'tracks'  : lambda t: t['file'],
+    'albums'  : lambda t: str((t.get('albumartist', t.get('artist')), t['album']))
+                          if 'album' in t else t['file'],
+    'artists' : lambda t: str(t.get('artist', t['file'])),
+}
+# Settings of auto-fill daemon: { 'unit': str, 'query': build_query list, 'count': int }
+autofill_channel = 'mpdmenu-autofill'
+autofill_recent = 500
+# Seconds to wait before reconnecting after connection is lost
+autofill_retry = 10
+
+def autofill_path():
+    return cache_path('autofill.json')
+
+def autofill_load():
+    try:
+        with open(autofill_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Group matching tracks of library into units picked by auto-fill: [[file, ...], ...]
+def autofill_groups(client, query, unit, reload=False):
+    key = autofill_units[unit]
+    groups = {}
+    for track in library_tracks(library_load(client, reload=reload)):
+        if match_query(track, query, 'search'):
+            groups.setdefault(key(track), []).append(track['file'])
+    return list(groups.values())
+
+"""Pick random unit not fully excluded, in O(1) amortized
+
+candidates are indices of groups not picked yet: picked or exhausted unit is
+swapped out of them, so it is never tried again during this refill.
+:return: files of unit not in exclude or [] if no such unit is left
+"""
+def autofill_pick(groups, candidates, exclude):
+    while candidates:
+        i = randrange(len(candidates))
+        files = [f for f in groups[candidates[i]] if f not in exclude]
+        candidates[i] = candidates[-1]
+        candidates.pop()
+        if files:
+            return files
+    return []
+
+def autofill_refill(client, groups, count, recent):
+    status = client.status()
+    upcoming = int(status['playlistlength']) - int(status.get('song', -1)) - 1
+    if upcoming >= count:
+        return
+    # Entries of playlist are 'file: <uri>'
+    queued = set(p.split(': ', 1)[-1] for p in client.playlist())
+    exclude = queued | set(recent)
+    candidates = list(range(len(groups)))
+    while upcoming < count:
+        files = autofill_pick(groups, candidates, exclude)
+        if not files:
+            if not recent:
+                break
+            # Everything was played recently: start over, skip queued only
+            recent.clear()
+            exclude = queued
+            candidates = list(range(len(groups)))
+            continue
+        for f in files:
+            try:
+                client.add(f)
+            except CommandError as e: # not in database anymore
+                print('auto-fill: skipped {}: {}'.format(f, e), file=stderr)
+                continue
+            upcoming += 1
+        exclude.update(files)
+        queued.update(files)
+
+"""Keep at least N upcoming tracks in queue (see autofill_load)
+
+Runs in daemon started by mpd_autofill until 'stop' is sent to autofill_channel
+"""
+def autofill_run(client):
+    config = autofill_load()
+    if not config:
+        print('auto-fill: no settings in {}'.format(autofill_path()), file=stderr)
+        return
+    groups = autofill_groups(client, config['query'], config['unit'])
+    if not groups:
+        print('auto-fill: no tracks match filter', file=stderr)
+    client.subscribe(autofill_channel)
+    recent = deque(maxlen=autofill_recent)
+    while groups:
+        current = client.currentsong()
+        if current and (not recent or recent[-1] != current['file']):
+            recent.append(current['file'])
+        autofill_refill(client, groups, config['count'], recent)
+        changed = client.idle('player', 'playlist', 'database', 'message')
+        if 'message' in changed:
+            messages = [m['message'] for m in client.readmessages()
+                    if m['channel'] == autofill_channel]
+            if 'stop' in messages:
+                break
+        if 'database' in changed:
+            groups = autofill_groups(client, config['query'], config['unit'],
+                    reload=True)
+
+def autofill_main(address, port, timeout):
+    global connect_args
+    connect_args = (address, port, timeout)
+    while True:
+        try:
+            client = mpd_connect(address, port, timeout)
+            try:
+                autofill_run(client)
+                return
+            finally:
+                client.disconnect()
+        except (ConnectionError, OSError) as e: # e.g. mpd is restarted
+            print('auto-fill: {}, reconnecting in {} s'.format(e, autofill_retry),
+                    file=stderr)
+            sleep(autofill_retry)
+        except KeyboardInterrupt:
+            return
+
+# Starts (detached from dmenu) or stops auto-fill daemon
+def mpd_autofill(client, command):
+    if autofill_channel in client.channels():
+        r = dmenu(['stop'], prompt='Auto-fill is running')
+        if not esc_pressed(r) and not none_selected(r) and r[0] == 'stop':
+            client.sendmessage(autofill_channel, 'stop')
+        return
+    r = dmenu(list(autofill_units), prompt='Pick')
+    if esc_pressed(r) or none_selected(r) or r[0] not in autofill_units:
+        return
+    unit = r[0]
+    config = autofill_load()
+    query = None
+    if config and config['query']:
+        r = dmenu(['previous filter', 'new filter'], prompt='Filter')
+        if esc_pressed(r) or none_selected(r):
+            return
+        if r[0] == 'previous filter':
+            query = config['query']
+    if query == None:
+        query = build_query(client, 'search')
+    count = config['count'] if config else 10
+    r = dmenu([str(count)], prompt='Keep upcoming', custominput=True)
+    if esc_pressed(r) or none_selected(r):
+        return
+    try:
+        count = int(r[0])
+    except ValueError:
+        return
+    makedirs(dirname(autofill_path()), exist_ok=True)
+    with open(autofill_path(), 'w') as f:
+        json.dump({'unit': unit, 'query': query, 'count': count}, f)
+    address, port, timeout = connect_args
+    # Daemon has no terminal: its errors go to log next to settings
+    with open(cache_path('autofill.log'), 'a') as log:
+        Popen([executable, abspath(__file__), '--autofill',
+                '-a', address, '-p', str(port), '-t', str(timeout)],
+                stdin=DEVNULL, stdout=DEVNULL, stderr=log,
+                start_new_session=True)
+
 def mpd_save_playlist(client, command):
     save_playlist(client)
 
@@ -600,6 +1135,7 @@ def mpd_options(client, command):
 
 def mpd_shuffle(client, command):
     playlist = client.playlistinfo()
+    stickers_refresh(client)
     tracks = dmenu_select_tracks(playlist, prompt='Select range',
             usepos=True, ranges=False)
     if esc_pressed(tracks):
@@ -662,7 +1198,11 @@ commands = {
     'find'             : mpd_search,
     'play'             : mpd_play,
     'current playlist' : mpd_current_playlist,
+    'rated playlist'   : mpd_current_playlist,
     'save playlist'    : mpd_save_playlist,
+    'dedupe queue'     : mpd_dedupe,
+    'auto-fill'        : mpd_autofill,
+    'library snapshot' : mpd_library,
     'all playlists'    : mpd_playlists,
     'options'          : mpd_options,
     'shuffle'          : mpd_shuffle,
@@ -670,10 +1210,17 @@ commands = {
     'update'           : mpd_update,
 }
 
-def main(address='localhost', port=6600, timeout=60):
+def mpd_connect(address, port, timeout):
     client = MPDClient();
     client.timeout = timeout;
     client.connect(address, port)
+    return client
+
+def main(address='localhost', port=6600, timeout=60):
+    global connect_args
+    connect_args = (address, port, timeout)
+    client = mpd_connect(address, port, timeout)
+    sticker_watch(mpd_connect(address, port, timeout))
 
     while True:
         try:
@@ -702,8 +1249,9 @@ if __name__=='__main__':
     address = 'localhost'
     port = 6600
     timeout = 60
+    autofill = False
     try:
-        opts, args = gnu_getopt(argv[1:], 'a:p:t:', ['address=', 'port=', 'timeout'])
+        opts, args = gnu_getopt(argv[1:], 'a:p:t:', ['address=', 'port=', 'timeout', 'autofill'])
         for opt in opts:
             key = opt[0]
             value = opt[1]
@@ -713,6 +1261,8 @@ if __name__=='__main__':
                 port=int(value)
             elif key in ['-t', '--timeout']:
                 timeout=int(value)
+            elif key == '--autofill':
+                autofill = True
             else:
                 usage()
                 exit(1)
@@ -720,6 +1270,10 @@ if __name__=='__main__':
         usage()
         exit(1)
 
+    if autofill:
+        autofill_main(address, port, timeout)
+        exit(0)
+
     if len(args) != 0:
         dmenu_cmd = ' '.join(args)
     else: